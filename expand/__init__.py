@@ -1,240 +1,387 @@
-from datetime import datetime
-from enum import Enum
-import json
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import logging
-from typing import List
+from typing import Any, Callable, Dict, Iterator, NamedTuple, Optional, Sequence, Tuple, Union
 
 import azure.functions as func  # type: ignore
+import orjson
 from dateutil.rrule import rrule
 from dateutil.rrule import MO, TU, WE, TH, FR, SA, SU, MONTHLY, WEEKLY
 
 MAX_COUNT = 1000
-WEEKDAYS = [MO,TU,WE,TH,FR]
-
-class FreqValues(Enum):
-    WEEKLY = "weeks"
-    MONTHLY = "months"
-
-class MonthTypeValues(Enum):
-    DAYS_OF_WEEK = "days of week"
-    DAYS_OF_MONTH = "days of month"
-    FIRST_WEEKDAY = "first weekday"
-    LAST_WEEKDAY = "last weekday"
-
-class WeekDayValues(Enum):
-    MONDAY = "monday"
-    TUESDAY = "tuesday"
-    WEDNESDAY = "wednesday"
-    THURSDAY = "thursday"
-    FRIDAY = "friday"
-    SATURDAY = "saturday"
-    SUNDAY = "sunday"
-
-class MonthNthDayValues(Enum):
-    FIRST = "1st"
-    SECOND = "2nd"
-    THIRD = "3rd"
-    FOURTH = "4th"
-    LAST = "last"
-
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    raw_body = req.get_body().decode('utf-8','ignore')
-    logging.info(f'Request body:\n {raw_body}')
-    
+MAX_LOG_BODY = 1024
+RESPONSE_CACHE_SIZE = 1024
+MAX_CACHED_BODY = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+class RecurRequest(NamedTuple):
+    freq: Optional[str]
+    start: Optional[str]
+    interval: Union[int, str] = 1
+    until: Optional[str] = None
+    month_type: Optional[str] = None
+    month_nth_days: Tuple[str, ...] = ()
+    month_days: Tuple[Union[int, str], ...] = ()
+    week_days: Tuple[str, ...] = ()
+
+class WeeklyRule(NamedTuple):
+    interval: int
+    until: Optional[datetime]
+    weekdays: Tuple[int, ...]
+
+class Recurrence(NamedTuple):
+    # WeeklyRule for weekly rules with week days, expanded without rrule
+    rule: Union[rrule, WeeklyRule]
+    dtstart: datetime
+    limit: Optional[int]
+
+DAYS_OF_WEEK = "days of week"
+DAYS_OF_MONTH = "days of month"
+FIRST_WEEKDAY = "first weekday"
+LAST_WEEKDAY = "last weekday"
+
+MONTH_TYPES = frozenset({ DAYS_OF_WEEK, DAYS_OF_MONTH, FIRST_WEEKDAY, LAST_WEEKDAY })
+
+FREQ_MAP = {
+    "weeks": WEEKLY,
+    "months": MONTHLY,
+}
+
+WEEK_DAY_INDEX: Dict[str, int] = {
+    "monday": MO.weekday,
+    "tuesday": TU.weekday,
+    "wednesday": WE.weekday,
+    "thursday": TH.weekday,
+    "friday": FR.weekday,
+    "saturday": SA.weekday,
+    "sunday": SU.weekday,
+}
+# Lowercase and capitalized names are matched without calling lower()
+WEEK_DAY_INDEX.update({ k.capitalize(): v for (k,v) in WEEK_DAY_INDEX.items() })
+
+# byweekday tuples for each 7-bit mask of weekday indexes (bit 0 = Monday)
+WEEK_DAYS_BY_MASK = [
+    tuple( wd for wd in (MO,TU,WE,TH,FR,SA,SU) if mask >> wd.weekday & 1 )
+    for mask in range(128)
+]
+
+WEEKDAYS = WEEK_DAYS_BY_MASK[0b0011111]
+
+# rrule arguments for month types that take no further parameters
+MONTH_TYPE_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    FIRST_WEEKDAY: { "bysetpos": 1, "byweekday": WEEKDAYS },
+    LAST_WEEKDAY: { "bysetpos": -1, "byweekday": WEEKDAYS },
+}
+
+MONTH_NTH_DAY_MAP = {
+    "1st": 1,
+    "2nd": 2,
+    "3rd": 3,
+    "4th": 4,
+    "last": -1,
+}
+
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    if logger.isEnabledFor(logging.DEBUG):
+        preview = req.get_body()[:MAX_LOG_BODY].decode('utf-8','ignore')
+        logger.debug('Request body:\n %s', preview)
+
+    content_type = req.headers.get('content-type','').split(';')[0].strip().lower()
+    if content_type not in ('application/json',''):
+        raise ValueError(f'Unsupported content type: "{content_type}"')
+    if not req.get_body():
+        raise ValueError('Missing request body')
+
     try:
         body = req.get_json()
     except ValueError:
         raise ValueError('Unable to parse request body')
+    if not isinstance(body, dict):
+        raise ValueError('Unable to parse request body')
 
     try:
-        r = parse_rrule(body)
+        recur = parse_request(body)
+        resp_body = cached_response(recur)
+        if resp_body is None:
+            resp_body = await asyncio.to_thread(build_response, recur)
+            cache_response(recur, resp_body)
     except ValueError as e:
-        logging.error(f'Parse error: {e}')
+        logger.error('Parse error: %s', e)
         raise e
-    
-    # TODO but what about timezones
-    resp = {
-      "instances": [ dt.strftime('%Y-%m-%d') for dt in next_instances(r) ]
-    }
-    resp_body = json.dumps(resp)
 
-    logging.info(f'Response body:\n {resp_body}')
+    logger.debug('Response body: %d bytes', len(resp_body))
 
     return func.HttpResponse(
-        resp_body.encode('utf-8'),
+        resp_body,
         status_code=200,
         mimetype='application/json',
         charset='utf-8',
     )
-    
 
-def parse_rrule(body) -> rrule:
-    raw_freq = body.get('freq',None)
-    raw_start = body.get('start',None)
-    raw_interval = body.get('interval',1)
-    raw_until = body.get('until',None)
-    raw_month_type = body.get('month_type',None)
-    raw_month_nth_days = body.get('month_nth_days',[])
-    raw_month_days = body.get('month_days',[])
-    raw_week_days = body.get('week_days',[])
-
-    if raw_freq is None:
+
+# Accessed only from the event loop; build_response runs in a worker thread
+RESPONSE_CACHE: "OrderedDict[RecurRequest, bytes]" = OrderedDict()
+
+def cached_response(recur: RecurRequest) -> Optional[bytes]:
+    resp_body = RESPONSE_CACHE.get(recur)
+    if resp_body is not None:
+        RESPONSE_CACHE.move_to_end(recur)
+    return resp_body
+
+def cache_response(recur: RecurRequest, resp_body: bytes) -> None:
+    # Rules with an until date are not capped at MAX_COUNT, so bodies can be huge
+    if len(resp_body) > MAX_CACHED_BODY:
+        return
+    RESPONSE_CACHE[recur] = resp_body
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+
+def build_response(recur: RecurRequest) -> bytes:
+    instances = next_instances(parse_rrule(recur))
+
+    # TODO but what about timezones
+    resp = {
+      "instances": list(map(datetime.date, instances))
+    }
+    return orjson.dumps(resp)
+
+
+def parse_request(body: dict) -> RecurRequest:
+    return RecurRequest(
+        freq=parse_optional_str(body, 'freq'),
+        start=parse_optional_str(body, 'start'),
+        interval=parse_interval(body.get('interval',1)),
+        until=parse_optional_str(body, 'until'),
+        month_type=parse_optional_str(body, 'month_type'),
+        month_nth_days=parse_list(body, 'month_nth_days', is_str),
+        month_days=parse_list(body, 'month_days', is_int_or_str),
+        week_days=parse_list(body, 'week_days', is_str),
+    )
+
+def parse_optional_str(body: dict, key: str) -> Optional[str]:
+    value = body.get(key,None)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'Invalid {key}: "{value}"')
+    return value
+
+def parse_interval(value) -> Union[int, str]:
+    if not is_int_or_str(value):
+        raise ValueError(f'Invalid interval: "{value}"')
+    interval: Union[int, str] = value
+    return interval
+
+def parse_list(body: dict, key: str, is_valid: Callable[[Any], bool]) -> tuple:
+    value = body.get(key,[])
+    if not isinstance(value, list) or not all( is_valid(v) for v in value ):
+        raise ValueError(f'Invalid {key}: "{value}"')
+    return tuple(value)
+
+def is_str(value) -> bool:
+    return isinstance(value, str)
+
+def is_int_or_str(value) -> bool:
+    # Numbers are whole: floats would be truncated by int(), and bool is an int subclass
+    return isinstance(value, (int, str)) and not isinstance(value, bool)
+
+
+def parse_rrule(recur: RecurRequest) -> Recurrence:
+    if recur.freq is None:
         raise ValueError('Missing required: freq')
-    if raw_start is None:
+    if recur.start is None:
         raise ValueError('Missing required: start')
     
-    freq = parse_freq(raw_freq)
-    start = parse_datetime(raw_start)
-    interval = int(raw_interval)
-    until = None if raw_until is None else parse_datetime(raw_until)
-
+    freq = parse_freq(recur.freq)
+    start = parse_datetime(recur.start)
+    interval = int(recur.interval)
+    if interval < 1:
+        raise ValueError(f'Invalid interval: "{recur.interval}"')
+    until = None if recur.until is None else parse_datetime(recur.until)
+    limit = None if until is not None else MAX_COUNT
+
+    rule: Union[rrule, WeeklyRule]
     if freq == WEEKLY:
-        week_days = parse_week_days(raw_week_days)
-        return rrule(
-            freq=freq,
-            dtstart=start,
-            interval=interval,
-            until=until,
-            byweekday=week_days,
-        )
-
-    if freq == MONTHLY:
-        if raw_month_type is None:
-            raise ValueError('Missing required: month_type')
-
-        month_type = parse_month_type(raw_month_type)
-
-        if month_type == MonthTypeValues.DAYS_OF_MONTH:
-            month_days = parse_month_days(raw_month_days)
-            return rrule(
+        week_days = parse_week_days(recur.week_days)
+        if week_days:
+            rule = WeeklyRule(interval, until, tuple( wd.weekday for wd in week_days ))
+        else:
+            rule = make_rrule(
                 freq=freq,
                 dtstart=start,
                 interval=interval,
                 until=until,
-                bymonthday=month_days,
+                byweekday=week_days,
             )
 
-        if month_type == MonthTypeValues.DAYS_OF_WEEK:
-            month_nth_days = parse_month_nth_days(raw_month_nth_days)
-            week_days = parse_week_days(raw_week_days)
-            return rrule(
+    elif freq == MONTHLY:
+        if recur.month_type is None:
+            raise ValueError('Missing required: month_type')
+
+        month_type = parse_month_type(recur.month_type)
+
+        template = MONTH_TYPE_TEMPLATES.get(month_type)
+        if template is not None:
+            rule = make_rrule(
                 freq=freq,
                 dtstart=start,
                 interval=interval,
                 until=until,
-                bysetpos=month_nth_days,
-                byweekday=week_days,
+                **template,
             )
-            
-        if month_type == MonthTypeValues.FIRST_WEEKDAY:
-            return rrule(
+
+        elif month_type == DAYS_OF_MONTH:
+            month_days = parse_month_days(recur.month_days)
+            rule = make_rrule(
                 freq=freq,
                 dtstart=start,
                 interval=interval,
                 until=until,
-                bysetpos=1,
-                byweekday=WEEKDAYS,
+                bymonthday=month_days,
             )
 
-        if month_type == MonthTypeValues.LAST_WEEKDAY:
-            return rrule(
+        elif month_type == DAYS_OF_WEEK:
+            month_nth_days = parse_month_nth_days(recur.month_nth_days)
+            week_days = parse_week_days(recur.week_days)
+            rule = make_rrule(
                 freq=freq,
                 dtstart=start,
                 interval=interval,
                 until=until,
-                bysetpos=-1,
-                byweekday=WEEKDAYS,
+                bysetpos=month_nth_days,
+                byweekday=week_days,
             )
 
-        raise ValueError('Month recurrence type not implemented: "{month_type}"')
-
-    raise ValueError('Frequency not implemented: "{freq}"')
-
+        else:
+            raise ValueError(f'Month recurrence type not implemented: "{month_type}"')
+
+    else:
+        raise ValueError('Frequency not implemented: "{freq}"')
+
+    return Recurrence(rule, start, limit)
+
+
+def make_rrule(
+    freq,
+    dtstart: datetime,
+    interval: int,
+    until: Optional[datetime],
+    byweekday=None,
+    bymonthday=None,
+    bysetpos=None,
+) -> rrule:
+    return rrule(
+        freq=freq,
+        dtstart=dtstart,
+        interval=interval,
+        until=until,
+        byweekday=byweekday,
+        bymonthday=bymonthday,
+        bysetpos=bysetpos,
+        wkst=MO,
+    )
 
 
 def parse_freq(s: str):
     try:
-        freq = FreqValues(s)
-    except ValueError:
+        return FREQ_MAP[s]
+    except KeyError:
         raise ValueError(f'Unknown freq: "{s}"')
-    if freq == freq.WEEKLY:
-        return WEEKLY
-    if freq == freq.MONTHLY:
-        return MONTHLY
 
-    raise ValueError(f'Unknown freq: "{s}"')
+def parse_week_days(raw: Sequence[str]):
+    mask = 0
+    for (i,s) in enumerate(raw):
+        mask |= 1 << parse_week_day(s,i)
+    return WEEK_DAYS_BY_MASK[mask]
 
-def parse_week_days(raw: List[str]):
-    return [ parse_week_day(s,i) for (i,s) in enumerate(raw) ]
-
-def parse_week_day(s: str, i: int):
+def parse_week_day(s: str, i: int) -> int:
+    week_day = WEEK_DAY_INDEX.get(s)
+    if week_day is not None:
+        return week_day
     try:
-        week_day = WeekDayValues(s.lower())
-    except ValueError:
+        return WEEK_DAY_INDEX[s.lower()]
+    except KeyError:
         raise ValueError(f'Unknown weekday: "{s}" ({i})')
-    if week_day == WeekDayValues.MONDAY:
-        return MO
-    if week_day == WeekDayValues.TUESDAY:
-        return TU
-    if week_day == WeekDayValues.WEDNESDAY:
-        return WE
-    if week_day == WeekDayValues.THURSDAY:
-        return TH
-    if week_day == WeekDayValues.FRIDAY:
-        return FR
-    if week_day == WeekDayValues.SATURDAY:
-        return SA
-    if week_day == WeekDayValues.SUNDAY:
-        return SU
-
-    raise ValueError(f'Unknown weekday: "{s}" ({i})')
-
-def parse_month_type(s: str):
-    try:
-        return MonthTypeValues(s.lower())
-    except ValueError:
+
+def parse_month_type(s: str) -> str:
+    if s in MONTH_TYPES:
+        return s
+    month_type = s.lower()
+    if month_type not in MONTH_TYPES:
         raise ValueError(f'Unknown month type: "{s}"')
+    return month_type
 
-def parse_month_days(raw: List[str]):
-    return [ int(s) for s in raw ]
+def parse_month_days(raw: Sequence[Union[int, str]]):
+    return tuple(sorted({ int(s) for s in raw }))
 
-def parse_month_nth_days(raw: List[str]):
-    return [ parse_month_nth_day(s,i) for (i,s) in enumerate(raw) ]
+def parse_month_nth_days(raw: Sequence[str]):
+    return tuple(sorted({ parse_month_nth_day(s,i) for (i,s) in enumerate(raw) }))
 
 def parse_month_nth_day(s: str, i: int):
     try:
-        month_nth_day = MonthNthDayValues(s)
-    except ValueError:
+        return MONTH_NTH_DAY_MAP[s]
+    except KeyError:
         raise ValueError(f'Unknown Month nth value: "{s}" ({i})')
-    if month_nth_day == MonthNthDayValues.FIRST:
-        return 1
-    if month_nth_day == MonthNthDayValues.SECOND:
-        return 2
-    if month_nth_day == MonthNthDayValues.THIRD:
-        return 3
-    if month_nth_day == MonthNthDayValues.FOURTH:
-        return 4
-    if month_nth_day == MonthNthDayValues.LAST:
-        return -1
-
-    raise ValueError(f'Unknown Month nth value: "{s}" ({i})')
 
  
 # TODO: timezone
 
 def parse_datetime(s: str) -> datetime:
     try:
-        return datetime.strptime(s,'%Y-%m-%d')
+        if not is_iso_date(s):
+            raise ValueError('expected YYYY-MM-DD')
+        return datetime.fromisoformat(s)
     except ValueError as e:
         raise ValueError(f'Unknown date string: "{s}": {e}')
 
-
-def next_instances(r: rrule):
-    return r.xafter(r._dtstart, count=None if is_finite(r) else MAX_COUNT, inc=False)
+def is_iso_date(s: str) -> bool:
+    # fromisoformat also accepts times, offsets and compact forms; only take YYYY-MM-DD
+    return (
+        len(s) == 10
+        and s.isascii()
+        and s[4] == s[7] == '-'
+        and (s[:4] + s[5:7] + s[8:]).isdigit()
+    )
 
 
-def is_finite(r: rrule) -> bool:
-    return not (r._count is None and r._until is None)
+def next_instances(recurrence: Recurrence) -> Iterator[datetime]:
+    (rule, dtstart, limit) = recurrence
+    if isinstance(rule, WeeklyRule):
+        return next_instances_weekly(dtstart, rule.interval, rule.until, rule.weekdays, limit)
+    instances: Iterator[datetime] = rule.xafter(dtstart, count=limit, inc=False)
+    return instances
+
+
+def next_instances_weekly(
+    dtstart: datetime,
+    interval: int,
+    until: Optional[datetime],
+    weekdays: Sequence[int],
+    count: Optional[int],
+) -> Iterator[datetime]:
+    # Equivalent to rrule.xafter(dtstart, inc=False) for a weekly rule with only
+    # byweekday set and weeks starting on Monday (wkst=MO, as in make_rrule),
+    # computed directly rather than via rrule's generic iteration
+    week = dtstart - timedelta(days=dtstart.weekday())
+    step = timedelta(weeks=interval)
+    days = [ timedelta(days=wd) for wd in sorted(weekdays) ]
+    n = 0
+    try:
+        while True:
+            for day in days:
+                dt = week + day
+                if dt <= dtstart:
+                    continue
+                if until is not None and dt > until:
+                    return
+                yield dt
+                n += 1
+                if count is not None and n >= count:
+                    return
+            week += step
+    except OverflowError:
+        return
 
 
@@ -0,0 +1,79 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from dateutil.rrule import rrule, weekday, MO, WEEKLY
+
+from expand import (
+    next_instances_weekly, parse_rrule, RecurRequest, WeeklyRule, MAX_COUNT
+)
+
+
+class TestNextInstancesWeekly(unittest.TestCase):
+
+    def assert_same_as_rrule(self, dtstart, interval, until, weekdays):
+        r = rrule(
+            freq=WEEKLY,
+            dtstart=dtstart,
+            interval=interval,
+            until=until,
+            byweekday=[ weekday(wd) for wd in weekdays ],
+            wkst=MO,
+        )
+        count = None if until is not None else MAX_COUNT
+        try:
+            expected = list(r.xafter(dtstart, count=count, inc=False))
+        except ValueError:
+            # rrule itself fails to iterate past datetime.MAXYEAR
+            return
+        actual = list(next_instances_weekly(dtstart, interval, until, weekdays, count))
+        self.assertEqual(
+            expected,
+            actual,
+            f'dtstart={dtstart} interval={interval} until={until} weekdays={weekdays}',
+        )
+
+    def test_matches_rrule_xafter(self):
+        rand = random.Random(1)
+        for _ in range(2000):
+            dtstart = datetime(rand.choice([1, 2000, 2024, 9985]), 1, 1) + timedelta(
+                days=rand.randrange(3000),
+                hours=rand.choice([0, 0, 5]),
+            )
+            interval = rand.choice([1, 2, 3, 7, 52, 1000])
+            until = rand.choice([ None, dtstart + timedelta(days=rand.randrange(-5, 800)) ])
+            weekdays = rand.sample(range(7), rand.randint(1, 7))
+            self.assert_same_as_rrule(dtstart, interval, until, weekdays)
+
+    def test_excludes_dtstart(self):
+        dtstart = datetime(2024, 1, 1)  # a Monday
+        actual = list(next_instances_weekly(dtstart, 1, datetime(2024, 1, 8), [0], None))
+        self.assertEqual([ datetime(2024, 1, 8) ], actual)
+
+    def test_stops_at_count(self):
+        actual = list(next_instances_weekly(datetime(2024, 1, 1), 1, None, [0, 2, 4], 5))
+        self.assertEqual(5, len(actual))
+
+
+class TestParseRRule(unittest.TestCase):
+
+    def test_weekly_with_week_days_uses_weekly_rule(self):
+        recurrence = parse_rrule(RecurRequest(
+            freq='weeks',
+            start='2024-01-01',
+            interval=2,
+            week_days=('friday', 'Monday'),
+        ))
+        self.assertEqual(WeeklyRule(2, None, (0, 4)), recurrence.rule)
+        self.assertEqual(datetime(2024, 1, 1), recurrence.dtstart)
+        self.assertEqual(MAX_COUNT, recurrence.limit)
+
+    def test_rejects_interval_below_one(self):
+        for interval in (0, -1):
+            with self.assertRaises(ValueError):
+                parse_rrule(RecurRequest(
+                    freq='weeks',
+                    start='2024-01-01',
+                    interval=interval,
+                    week_days=('monday',),
+                ))